@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+訊號截圖：背景 process pool 畫 K 線 PNG，畫好再丟給 TG sendPhoto
+
+- K 線用 LineCollection（影線）+ PolyCollection（實體）一次畫完，不再每根 ax.plot + Rectangle
+- 只用 matplotlib.figure.Figure（Agg），不碰 pyplot，worker 裡不需要螢幕
+- 文字訊號照常先送；圖在背景畫、背景送，不拖慢訊號
+"""
+from __future__ import annotations
+
+import os, re
+import multiprocessing
+from dataclasses import asdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection, PolyCollection
+
+UP_COLOR = "#26a69a"
+DOWN_COLOR = "#ef5350"
+BODY_HALF_WIDTH = 0.3
+
+LEVEL_STYLES = [
+    ("entry", "#1f77b4"),
+    ("stop",  "#d62728"),
+    ("tp1",   "#2ca02c"),
+    ("tp2",   "#2ca02c"),
+]
+
+# =========================================================
+# Drawing
+# =========================================================
+def draw_signal_chart(fig: Figure, ohlc: np.ndarray, sig: dict):
+    """ohlc: shape (n, 4) = open, high, low, close；sig: asdict(Signal)"""
+    ax = fig.add_subplot(111)
+    ax.set_title(f"{sig['symbol']} 45m | {sig['direction']} | {sig['reason']} | close={sig['candle_close_time_utc']}")
+    ax.set_xlabel("Bars")
+    ax.set_ylabel("Price")
+
+    o, h, l, c = (ohlc[:, i].astype(float) for i in range(4))
+    x = np.arange(len(o), dtype=float)
+    colors = np.where(c >= o, UP_COLOR, DOWN_COLOR)
+
+    # 影線：每根一條 (x, low) -> (x, high)
+    wicks = np.stack([np.column_stack([x, l]), np.column_stack([x, h])], axis=1)
+    ax.add_collection(LineCollection(wicks, colors=colors, linewidths=1))
+
+    # 實體：十字線給一點點高度才看得到
+    bottom = np.minimum(o, c)
+    top = np.maximum(np.maximum(o, c), bottom + 1e-9)
+    left, right = x - BODY_HALF_WIDTH, x + BODY_HALF_WIDTH
+    bodies = np.stack([
+        np.column_stack([left, bottom]),
+        np.column_stack([left, top]),
+        np.column_stack([right, top]),
+        np.column_stack([right, bottom]),
+    ], axis=1)
+    ax.add_collection(PolyCollection(bodies, facecolors=colors, edgecolors=colors, linewidths=0.5))
+
+    for name, color in LEVEL_STYLES:
+        price = float(sig[name])
+        ax.axhline(price, linestyle="--", linewidth=1, color=color)
+        ax.text(len(x) - 0.5, price, f" {name} {price:.6g}", color=color, fontsize=8, va="center",
+                bbox=dict(facecolor="white", edgecolor="none", pad=1))
+
+    ax.set_xlim(-1, len(x) + 6)
+    ax.autoscale_view(scalex=False)
+    ax.grid(True, alpha=0.2)
+    fig.tight_layout()
+
+def render_signal_png(ohlc: np.ndarray, sig: dict, path: str, dpi: int = 110) -> str:
+    """worker 進入點（要能 pickle，所以只收 numpy / dict / str）"""
+    fig = Figure(figsize=(12, 6))
+    draw_signal_chart(fig, ohlc, sig)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fig.savefig(path, dpi=dpi)
+    return path
+
+def chart_filename(sig: dict) -> str:
+    close = re.sub(r"[^0-9A-Za-z]+", "", sig["candle_close_time_utc"])
+    return f"{sig['symbol']}_{sig['direction']}_{close}.png"
+
+# =========================================================
+# Pool
+# =========================================================
+def _worker_init():
+    # 畫圖 worker 降優先權，CPU 先讓給掃描
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+class ChartPool:
+    """
+    submit() 只把資料丟進 process pool 就回來；
+    畫好之後由單一 sender thread 依序呼叫 send(path, caption)，送完就刪檔（keep_files=True 才留著）
+    """
+    def __init__(self, send, out_dir: str = "charts", max_workers: int = 2, bars: int = 140,
+                 keep_files: bool = False):
+        self.send = send
+        self.out_dir = out_dir
+        self.bars = bars
+        self.keep_files = keep_files
+        # 用 spawn：主程式已經有 SignalStore 的 writer thread 跟 SQLite 連線，fork 出來的 worker 可能卡在別人的鎖上
+        self._render = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_worker_init,
+        )
+        self._sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chart-sender")
+
+    def submit(self, df45_closed: pd.DataFrame, sig):
+        ohlc = df45_closed.tail(self.bars)[["open", "high", "low", "close"]].to_numpy(dtype=float)
+        s = sig if isinstance(sig, dict) else asdict(sig)
+        path = os.path.join(self.out_dir, chart_filename(s))
+        caption = f"{s['symbol']} {s['direction']} | 45m"
+
+        fut = self._render.submit(render_signal_png, ohlc, s, path)
+        fut.add_done_callback(lambda f: self._sender.submit(self._deliver, f, caption))
+        return fut
+
+    def _deliver(self, fut, caption: str):
+        try:
+            path = fut.result()
+        except Exception as e:
+            print(f"❌ chart render failed ({caption}): {e}")
+            return
+        try:
+            self.send(path, caption)
+        except Exception as e:
+            print(f"❌ chart send failed ({caption}): {e}")
+        finally:
+            if not self.keep_files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def close(self, wait: bool = True):
+        # 先等畫完（callback 會把送圖排進 sender），再等送完
+        self._render.shutdown(wait=wait)
+        self._sender.shutdown(wait=wait)
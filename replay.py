@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+"""
+離線回放：用錄好的 BingX / Binance 回應 + 虛擬時鐘，驅動 strategy_45m.scan_once 與 MACD 掃描的 run_once。
+
+  錄製（需連網）：
+    python replay.py record-45m --rec rec/ --start 2025-10-18 --end 2025-10-19
+    python replay.py tap-run-once --rec rec/            # 每跑一次就多一份快照（可放 cron）
+
+  回放（離線）：
+    python replay.py scan     --rec rec/ --start 2025-10-18 --end 2025-10-19 --out out/v1
+    python replay.py run-once --rec rec/ --start 2025-10-18 --end 2025-10-19 --out out/v1
+
+輸出 signals.jsonl / tg.jsonl（可直接 diff 兩個版本）與 timing.json（各階段耗時）。
+"""
+from __future__ import annotations
+
+import os, json, time, types, argparse, threading
+import importlib.machinery, importlib.util
+from contextlib import contextmanager, ExitStack
+from dataclasses import asdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+import requests
+import pandas as pd
+from requests.adapters import HTTPAdapter
+
+import strategy_45m as s45
+from signal_store import SignalStore
+
+# =========================================================
+# Config
+# =========================================================
+RECORD_FILE = "recording.jsonl"
+MACD_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Macd背離+資費+持倉量")
+
+# 這些參數每次呼叫都不同，不拿來當錄製檔的 key
+# （limit 只有 series 拿掉，因為 series 自己會照 limit 切；snapshot 的 limit 不同就是不同回應）
+VOLATILE_PARAMS = {"startTime", "endTime", "timestamp"}
+SERIES_VOLATILE_PARAMS = VOLATILE_PARAMS | {"limit"}
+
+# BingX v3 klines 一次最多抓幾根（錄製用）
+BINGX_PAGE = 1000
+
+# =========================================================
+# Virtual clock
+# =========================================================
+class VirtualClock:
+    def __init__(self, start: pd.Timestamp):
+        self._ms = float(pd.Timestamp(start).tz_convert("UTC").value // 1_000_000)
+        self._lock = threading.Lock()
+
+    def now(self) -> pd.Timestamp:
+        return pd.Timestamp(int(self._ms), unit="ms", tz="UTC")
+
+    def now_ms(self) -> int:
+        return int(self._ms)
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            with self._lock:
+                self._ms += seconds * 1000
+
+    def time(self) -> float:
+        return self._ms / 1000
+
+# =========================================================
+# Recording store
+# =========================================================
+def _key(path: str, params: dict, volatile: set = VOLATILE_PARAMS) -> str:
+    kept = sorted((k, str(v)) for k, v in params.items() if k not in volatile)
+    return path + "?" + "&".join(f"{k}={v}" for k, v in kept)
+
+def _row_ms(row, time_field) -> int:
+    return int(float(row[time_field]))
+
+class Recording:
+    """
+    recording.jsonl 一行一筆：
+      series   : K 線這種「時間序列」，回放時只給虛擬時間之前已經開盤的 K
+      snapshot : 其他回應原樣保存，回放時給 at <= 現在 的最新一份
+    """
+    def __init__(self):
+        self.series = {}     # key -> entry
+        self.snapshots = {}  # key -> [entry, ...] 依 at 排序
+
+    @classmethod
+    def load(cls, rec_dir: str) -> "Recording":
+        rec = cls()
+        with open(os.path.join(rec_dir, RECORD_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    rec.add(json.loads(line))
+        return rec
+
+    def add(self, entry: dict):
+        if entry["kind"] == "series":
+            k = _key(entry["path"], entry["params"], SERIES_VOLATILE_PARAMS)
+            tf = entry["time_field"]
+            old = self.series.get(k)
+            rows = {_row_ms(r, tf): r for r in (old["rows"] if old else [])}
+            rows.update({_row_ms(r, tf): r for r in entry["rows"]})
+            self.series[k] = dict(entry, rows=[rows[t] for t in sorted(rows)])
+        else:
+            snaps = self.snapshots.setdefault(_key(entry["path"], entry["params"]), [])
+            snaps.append(entry)
+            snaps.sort(key=lambda e: e["at"])
+
+    def lookup(self, path: str, params: dict, now_ms: int):
+        """回傳 (payload, found)"""
+        k = _key(path, params, SERIES_VOLATILE_PARAMS)
+        if k in self.series:
+            e = self.series[k]
+            tf = e["time_field"]
+            start = int(params.get("startTime", 0))
+            end = min(int(params.get("endTime", now_ms)), now_ms)
+            rows = [r for r in e["rows"] if start <= _row_ms(r, tf) <= end]
+            if "limit" in params:
+                rows = rows[-int(params["limit"]):]
+            if e.get("envelope") == "bingx":
+                return {"code": 0, "msg": "", "data": rows}, True
+            return rows, True
+
+        k = _key(path, params)
+        # 只給已經錄到的；虛擬時間之前沒有快照就當 miss（不拿未來的資料充數）
+        past = [e for e in self.snapshots.get(k, []) if e["at"] <= now_ms]
+        if past:
+            return past[-1]["payload"], True
+
+        return {"code": 404, "msg": f"not recorded: {k}"}, False
+
+def append_entries(rec_dir: str, entries: list[dict]):
+    os.makedirs(rec_dir, exist_ok=True)
+    with open(os.path.join(rec_dir, RECORD_FILE), "a", encoding="utf-8") as f:
+        for e in entries:
+            f.write(json.dumps(e, ensure_ascii=False) + "\n")
+
+# =========================================================
+# Local stand-in HTTP server
+# =========================================================
+class ReplayServer:
+    def __init__(self, rec: Recording, clock: VirtualClock):
+        self.rec = rec
+        self.clock = clock
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                u = urlsplit(self.path)
+                params = dict(parse_qsl(u.query))
+                payload, found = server.rec.lookup(u.path, params, server.clock.now_ms())
+                with server._lock:
+                    bucket = server.hits if found else server.misses
+                    bucket[u.path] = bucket.get(u.path, 0) + 1
+
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(200 if found else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class _RedirectAdapter(HTTPAdapter):
+    """把 session 的請求（不論原本 host）全部轉到本機回放 server"""
+    def __init__(self, base_url: str):
+        super().__init__()
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        u = urlsplit(request.url)
+        request.url = self.base_url + u.path + (f"?{u.query}" if u.query else "")
+        return super().send(request, **kwargs)
+
+class _TapAdapter(HTTPAdapter):
+    """照常連線，同時把回應存成 snapshot"""
+    def __init__(self, entries: list, lock: threading.Lock):
+        super().__init__()
+        self.entries = entries
+        self.lock = lock
+
+    def send(self, request, **kwargs):
+        resp = super().send(request, **kwargs)
+        try:
+            u = urlsplit(request.url)
+            entry = {
+                "kind": "snapshot",
+                "path": u.path,
+                "params": dict(parse_qsl(u.query)),
+                "at": int(time.time() * 1000),
+                "payload": resp.json(),
+            }
+            with self.lock:
+                self.entries.append(entry)
+        except Exception:
+            pass
+        return resp
+
+# =========================================================
+# Timing / output
+# =========================================================
+class Timings:
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, name: str, fn):
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                dt = (time.perf_counter() - t0) * 1000
+                with self._lock:
+                    self.samples.setdefault(name, []).append(dt)
+        return timed
+
+    def report(self) -> dict:
+        out = {}
+        for name, xs in sorted(self.samples.items()):
+            s = pd.Series(xs)
+            out[name] = {
+                "count": int(s.size),
+                "total_ms": round(float(s.sum()), 3),
+                "mean_ms": round(float(s.mean()), 3),
+                "p50_ms": round(float(s.quantile(0.50)), 3),
+                "p95_ms": round(float(s.quantile(0.95)), 3),
+                "max_ms": round(float(s.max()), 3),
+            }
+        return out
+
+def write_jsonl(path: str, rows: list[dict]):
+    with open(path, "w", encoding="utf-8") as f:
+        for r in rows:
+            f.write(json.dumps(r, ensure_ascii=False, sort_keys=True) + "\n")
+
+def write_outputs(out_dir: str, signals: list, tg: list, timings: Timings, server: ReplayServer, meta: dict):
+    os.makedirs(out_dir, exist_ok=True)
+    write_jsonl(os.path.join(out_dir, "signals.jsonl"), signals)
+    write_jsonl(os.path.join(out_dir, "tg.jsonl"), tg)
+
+    report = dict(meta, stages=timings.report(), http_hits=server.hits, http_misses=server.misses)
+    with open(os.path.join(out_dir, "timing.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+    print(f"✅ replay done: {meta['cycles']} cycles, {len(signals)} signals, "
+          f"{meta['wall_seconds']:.2f}s wall -> {out_dir}")
+    if server.misses:
+        print(f"⚠️ not recorded: {server.misses}")
+
+@contextmanager
+def patched(obj, **attrs):
+    old = {k: getattr(obj, k) for k in attrs}
+    for k, v in attrs.items():
+        setattr(obj, k, v)
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            setattr(obj, k, v)
+
+# =========================================================
+# Replay: strategy_45m.scan_once
+# =========================================================
+def replay_scan(rec: Recording, start: pd.Timestamp, end: pd.Timestamp, out_dir: str, charts: bool = False):
+    clock = VirtualClock(start)
+    timings = Timings()
+    signals, tg, photos = [], [], []
+
+    def record_tg(text: str):
+        tg.append({"at": clock.now().isoformat(), "text": text})
+
+    def record_photo(path: str, caption: str = ""):
+        # 從 sender thread 進來，順序不固定，寫檔前再排序
+        photos.append({"photo": os.path.basename(path), "caption": caption})
+
+    def compute(df45_closed, symbol):
+        sig = compute_orig(df45_closed, symbol)
+        if sig:
+            signals.append(dict(asdict(sig), scan_at=clock.now().isoformat()))
+        return sig
+
+    compute_orig = s45.compute_signal_only_if_last2_engulf
+
+    with ReplayServer(rec, clock) as server, ExitStack() as stack:
+        stack.enter_context(patched(
+            s45,
+            BINGX_BASE=server.url,
+            ENABLE_TG=True,
+            PLOT_ON_SIGNAL=False,
+            utc_now_ts=clock.now,
+            sleep_seconds=clock.sleep,
+            tg_send=timings.wrap("tg_send", record_tg),
+            tg_send_photo=record_photo,
+            CHART_DIR=os.path.join(out_dir, "charts"),
+            fetch_bingx_swap_klines=timings.wrap("fetch_bingx_swap_klines", s45.fetch_bingx_swap_klines),
+            resample_to_45m=timings.wrap("resample_to_45m", s45.resample_to_45m),
+            drop_unclosed_45m=timings.wrap("drop_unclosed_45m", s45.drop_unclosed_45m),
+            compute_signal_only_if_last2_engulf=timings.wrap("compute_signal", compute),
+        ))
+        scan = timings.wrap("scan_once", s45.scan_once)
+
+        # 每次回放都用全新的狀態庫，放在輸出資料夾裡（回放完可以直接查 journal）
+        os.makedirs(out_dir, exist_ok=True)
+        db = os.path.join(out_dir, s45.STATE_DB)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db + suffix):
+                os.remove(db + suffix)
+        state = SignalStore(db, market="bingx_swap", timeframe=f"{s45.TARGET_INTERVAL_MIN}m", now=clock.now)
+        pool = s45.open_chart_pool(keep_files=True) if charts else None
+
+        cycles = 0
+        t0 = time.perf_counter()
+        while True:
+            s45.wait_until_next_45m_close(grace_seconds=s45.GRACE_SECONDS, tz_name="Asia/Taipei")
+            if clock.now() > end:
+                break
+            scan(state, pool)
+            cycles += 1
+        state.close()
+        if pool:
+            pool.close()
+            write_jsonl(os.path.join(out_dir, "charts.jsonl"), sorted(photos, key=lambda r: r["photo"]))
+
+        meta = {
+            "mode": "scan",
+            "charts": len(photos),
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "cycles": cycles,
+            "wall_seconds": time.perf_counter() - t0,
+        }
+        write_outputs(out_dir, signals, tg, timings, server, meta)
+
+# =========================================================
+# Replay: Macd背離+資費+持倉量 run_once
+# =========================================================
+def load_macd_module():
+    loader = importlib.machinery.SourceFileLoader("macd_scan", MACD_SCRIPT)
+    spec = importlib.util.spec_from_loader("macd_scan", loader)
+    mod = importlib.util.module_from_spec(spec)
+    loader.exec_module(mod)
+    return mod
+
+def replay_run_once(rec: Recording, start: pd.Timestamp, end: pd.Timestamp, out_dir: str):
+    macd = load_macd_module()
+    clock = VirtualClock(start)
+    timings = Timings()
+    signals, tg = [], []
+
+    def record_tg(text: str):
+        tg.append({"at": clock.now().isoformat(), "text": text})
+        signals.append({"scan_at": cycle_at, "text": text})
+
+    with ReplayServer(rec, clock) as server, ExitStack() as stack:
+        macd.session.mount("https://", _RedirectAdapter(server.url))
+        macd.session.mount("http://", _RedirectAdapter(server.url))
+        stack.enter_context(patched(
+            macd,
+            time=types.SimpleNamespace(sleep=clock.sleep, time=clock.time),
+            ALWAYS_SEND=True,
+            tg_send=timings.wrap("tg_send", record_tg),
+            process_symbol=timings.wrap("process_symbol", macd.process_symbol),
+            get_top_open_interest_changes=timings.wrap("get_top_open_interest_changes",
+                                                       macd.get_top_open_interest_changes),
+        ))
+        run = timings.wrap("run_once", macd.run_once)
+
+        cycles = 0
+        t0 = time.perf_counter()
+        while clock.now() <= end:
+            cycle_at = clock.now().isoformat()
+            run()
+            cycles += 1
+            # 跟 scheduler_loop 一樣：台灣時間 0~6 點每 3 小時，其餘每 2 小時
+            hour = clock.now().tz_convert(macd.TZ.zone).hour
+            clock.sleep(3 * 3600 if 0 <= hour < 6 else 2 * 3600)
+
+        meta = {
+            "mode": "run-once",
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "cycles": cycles,
+            "wall_seconds": time.perf_counter() - t0,
+        }
+        write_outputs(out_dir, signals, tg, timings, server, meta)
+
+# =========================================================
+# Record (needs network)
+# =========================================================
+def series_gaps(rows: list, time_field, int_ms: int) -> list[tuple[int, int]]:
+    """回傳相鄰兩根開盤時間差 != int_ms 的 (前一根, 後一根)"""
+    ts = [_row_ms(r, time_field) for r in rows]
+    return [(a, b) for a, b in zip(ts, ts[1:]) if b - a != int_ms]
+
+def record_45m(rec_dir: str, start: pd.Timestamp, end: pd.Timestamp):
+    """回補 BingX 15m K（含 LIMIT_15M 根暖機），寫成 series"""
+    path = "/openApi/swap/v3/quote/klines"
+    int_ms = s45.interval_to_ms(s45.SOURCE_INTERVAL)
+    start_ms = int(start.value // 1_000_000) - s45.LIMIT_15M * int_ms
+    end_ms = int(end.value // 1_000_000)
+
+    entries = []
+    for sym, bingx_symbol in s45.BINGX_SWAP_SYMBOLS.items():
+        rows, cur = [], start_ms
+        while cur <= end_ms:
+            # 開盤時間含頭含尾，BINGX_PAGE 根只跨 (BINGX_PAGE - 1) 個間隔，不然每頁邊界會掉一根
+            page_end = min(cur + (BINGX_PAGE - 1) * int_ms, end_ms)
+            r = requests.get(s45.BINGX_BASE + path, params={
+                "symbol": bingx_symbol,
+                "interval": s45.SOURCE_INTERVAL,
+                "startTime": str(cur),
+                "endTime": str(page_end),
+                "limit": str(BINGX_PAGE),
+            }, timeout=20)
+            r.raise_for_status()
+            rows.extend(r.json().get("data") or [])
+            cur = page_end + 1
+
+        # 同一根只留一筆、照時間排，再檢查有沒有缺K（缺K會讓回放的45m跟正式跑的不一樣）
+        by_t = {_row_ms(r, "time"): r for r in rows}
+        rows = [by_t[t] for t in sorted(by_t)]
+        gaps = series_gaps(rows, "time", int_ms)
+        if gaps:
+            print(f"⚠️ {sym}: {len(gaps)} gaps in recorded {s45.SOURCE_INTERVAL} bars, first at "
+                  f"{pd.Timestamp(gaps[0][0], unit='ms', tz='UTC')} -> {pd.Timestamp(gaps[0][1], unit='ms', tz='UTC')}")
+
+        entries.append({
+            "kind": "series",
+            "path": path,
+            "params": {"symbol": bingx_symbol, "interval": s45.SOURCE_INTERVAL},
+            "time_field": "time",
+            "envelope": "bingx",
+            "rows": rows,
+        })
+        print(f"📼 {sym}: {len(rows)} bars")
+
+    append_entries(rec_dir, entries)
+
+def tap_run_once(rec_dir: str):
+    """正常連線跑一次 run_once，所有回應存成 snapshot（不發 TG）"""
+    macd = load_macd_module()
+    entries, lock = [], threading.Lock()
+    macd.session.mount("https://", _TapAdapter(entries, lock))
+    with patched(macd, tg_send=lambda text: None):
+        macd.run_once()
+    append_entries(rec_dir, entries)
+    print(f"📼 tapped {len(entries)} responses")
+
+# =========================================================
+# CLI
+# =========================================================
+def _ts(s: str) -> pd.Timestamp:
+    t = pd.Timestamp(s)
+    return t.tz_localize("Asia/Taipei").tz_convert("UTC") if t.tzinfo is None else t.tz_convert("UTC")
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Offline replay for strategy_45m / MACD scanner")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    for name in ("scan", "run-once", "record-45m"):
+        sp = sub.add_parser(name)
+        sp.add_argument("--rec", required=True)
+        sp.add_argument("--start", required=True, help="沒帶時區就當台灣時間")
+        sp.add_argument("--end", required=True)
+        if name != "record-45m":
+            sp.add_argument("--out", required=True)
+        if name == "scan":
+            sp.add_argument("--charts", action="store_true", help="連訊號截圖一起跑（PNG 放在 out/charts）")
+
+    sp = sub.add_parser("tap-run-once")
+    sp.add_argument("--rec", required=True)
+
+    a = p.parse_args(argv)
+    if a.cmd == "tap-run-once":
+        tap_run_once(a.rec)
+        return
+
+    start, end = _ts(a.start), _ts(a.end)
+    if a.cmd == "record-45m":
+        record_45m(a.rec, start, end)
+    elif a.cmd == "scan":
+        replay_scan(Recording.load(a.rec), start, end, a.out, charts=a.charts)
+    else:
+        replay_run_once(Recording.load(a.rec), start, end, a.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+訊號狀態儲存（取代 last_seen_local.json）
+
+  signal_journal : 只追加的訊號日誌，每次算出的訊號都留一筆（含有沒有送 TG），之後可拿來分析
+  latest_signal  : (market, timeframe, symbol) -> 最新 close|direction，用來去重
+
+共用方式：
+- 多個 process：各自開一個 SignalStore 指向同一個 SQLite 檔（WAL 模式）
+- 同一個 process 裡多個 thread：共用同一個 SignalStore 物件，claim() 內部有鎖
+
+去重：
+- 先查記憶體快取（O(1)）；已經看過、或比看過的還舊的K，直接 False，不碰 DB
+- 真的比較新才對 DB 做一次有條件的 upsert（只往新的K前進），確保兩個 worker 不會同時送同一根
+- ⚠️ 這一次 upsert 是同步寫在掃描路徑上的（跨 process 去重一定要當下知道結果）；
+  為了不卡掃描，busy timeout 只等 CLAIM_BUSY_MS，等不到就當新訊號送（寧可多送不要漏）
+- journal 才是真的丟背景 thread 批次寫，不在掃描路徑上
+
+時間戳（recorded_at / updated_at）用建構時傳進來的 now()，回放時可以換成虛擬時鐘
+"""
+from __future__ import annotations
+
+import os, json, queue, sqlite3, threading
+from dataclasses import asdict
+from datetime import datetime, timezone
+from typing import Callable
+
+# claim() 在掃描路徑上，別的 worker 拿著寫鎖時最多等這麼久（ms）
+CLAIM_BUSY_MS = 200
+# 開檔建表、背景 journal 不在掃描路徑上，可以等久一點
+BACKGROUND_BUSY_MS = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signal_journal (
+    id                    INTEGER PRIMARY KEY AUTOINCREMENT,
+    recorded_at           TEXT NOT NULL,
+    market                TEXT NOT NULL,
+    timeframe             TEXT NOT NULL,
+    symbol                TEXT NOT NULL,
+    direction             TEXT NOT NULL,
+    candle_open_time_utc  TEXT NOT NULL,
+    candle_close_time_utc TEXT NOT NULL,
+    entry                 REAL,
+    stop                  REAL,
+    tp1                   REAL,
+    tp2                   REAL,
+    r                     REAL,
+    reason                TEXT,
+    sent                  INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_journal_symbol_close
+    ON signal_journal (market, timeframe, symbol, candle_close_time_utc);
+
+CREATE TABLE IF NOT EXISTS latest_signal (
+    market                TEXT NOT NULL,
+    timeframe             TEXT NOT NULL,
+    symbol                TEXT NOT NULL,
+    candle_close_time_utc TEXT NOT NULL,
+    direction             TEXT NOT NULL,
+    updated_at            TEXT NOT NULL,
+    PRIMARY KEY (market, timeframe, symbol)
+);
+"""
+
+# 只往前走：close 比較新，或同一根K但方向不同，才算新訊號
+# rowcount == 0 代表 DB 裡已經有一樣或更新的（別的 worker 搶先了），不能再送
+# （close 都是同格式的 UTC isoformat，字串比較就是時間比較）
+CLAIM_SQL = """
+INSERT INTO latest_signal (market, timeframe, symbol, candle_close_time_utc, direction, updated_at)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (market, timeframe, symbol) DO UPDATE SET
+    candle_close_time_utc = excluded.candle_close_time_utc,
+    direction             = excluded.direction,
+    updated_at            = excluded.updated_at
+WHERE excluded.candle_close_time_utc > latest_signal.candle_close_time_utc
+   OR (excluded.candle_close_time_utc = latest_signal.candle_close_time_utc
+       AND excluded.direction <> latest_signal.direction)
+"""
+
+JOURNAL_SQL = """
+INSERT INTO signal_journal (
+    recorded_at, market, timeframe, symbol, direction,
+    candle_open_time_utc, candle_close_time_utc, entry, stop, tp1, tp2, r, reason, sent
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_STOP = object()
+
+def _utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+def _is_newer(close: str, direction: str, seen: tuple[str, str] | None) -> bool:
+    """跟 CLAIM_SQL 的 WHERE 同一套規則"""
+    if seen is None:
+        return True
+    seen_close, seen_dir = seen
+    return close > seen_close or (close == seen_close and direction != seen_dir)
+
+def _connect(path: str, busy_ms: int = BACKGROUND_BUSY_MS, check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=busy_ms / 1000, isolation_level=None,
+                           check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(busy_ms)}")
+    return conn
+
+def _executemany_tx(conn: sqlite3.Connection, sql: str, rows: list):
+    # isolation_level=None 是 autocommit，批次寫要自己包 transaction
+    # COMMIT 失敗也要 ROLLBACK，不然 transaction 一直開著，之後每次 BEGIN 都會失敗
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(sql, rows)
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+class SignalStore:
+    def __init__(self, path: str, market: str, timeframe: str, legacy_json: str | None = None,
+                 now: Callable[[], datetime] = _utc_now):
+        self.path = path
+        self.market = market
+        self.timeframe = timeframe
+        self.now = now
+
+        # 掃描 thread 共用這條連線，claim() 用 _lock 排隊
+        self._conn = _connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        if legacy_json:
+            self._import_legacy_json(legacy_json)
+        self._conn.execute(f"PRAGMA busy_timeout={CLAIM_BUSY_MS}")
+        self._lock = threading.Lock()
+
+        # symbol -> (close, direction)，只存這個 market/timeframe 的
+        self._latest = {
+            sym: (close, direction)
+            for sym, close, direction in self._conn.execute(
+                "SELECT symbol, candle_close_time_utc, direction FROM latest_signal "
+                "WHERE market = ? AND timeframe = ?",
+                (market, timeframe),
+            )
+        }
+
+        self._q = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="signal-store-writer", daemon=True)
+        self._writer.start()
+
+    # -----------------------------------------------------
+    # hot path
+    # -----------------------------------------------------
+    def claim(self, symbol: str, candle_close_time_utc: str, direction: str) -> bool:
+        """True = 這根K這個方向第一次出現、比看過的都新，而且是這個 process 搶到的"""
+        with self._lock:
+            if not _is_newer(candle_close_time_utc, direction, self._latest.get(symbol)):
+                return False
+
+            try:
+                rc = self._conn.execute(
+                    CLAIM_SQL,
+                    (self.market, self.timeframe, symbol, candle_close_time_utc, direction,
+                     self.now().isoformat()),
+                ).rowcount
+            except sqlite3.Error as e:
+                # DB 壞了或等不到鎖，寧可多送一次，也不要漏訊號
+                print(f"❌ state claim failed for {symbol}: {e}")
+                rc = 1
+
+            # rc == 0 時 DB 裡已經 >= 這根，快取往前推到這根也不會錯
+            self._latest[symbol] = (candle_close_time_utc, direction)
+            return rc > 0
+
+    def append(self, sig, sent: bool):
+        """丟進背景 thread 寫 journal，不等"""
+        self._q.put((self.now().isoformat(), asdict(sig), bool(sent)))
+
+    # -----------------------------------------------------
+    # lifecycle
+    # -----------------------------------------------------
+    def flush(self):
+        self._q.join()
+
+    def close(self):
+        self.flush()
+        self._q.put(_STOP)
+        self._writer.join()
+        self._conn.close()
+
+    # -----------------------------------------------------
+    # internals
+    # -----------------------------------------------------
+    def _write_loop(self):
+        conn = _connect(self.path)
+        while True:
+            item = self._q.get()
+            batch = [item]
+            # 一次把排隊中的都拿出來，一個 transaction 寫完
+            while True:
+                try:
+                    batch.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+
+            # 任何錯誤都只印出來；writer 死掉的話 flush()/close() 會永遠卡在 q.join()
+            items = [it for it in batch if it is not _STOP]
+            try:
+                rows = [self._journal_row(*it) for it in items]
+                if rows:
+                    _executemany_tx(conn, JOURNAL_SQL, rows)
+            except Exception as e:
+                print(f"❌ state journal write failed ({len(items)} rows): {e}")
+            finally:
+                for _ in batch:
+                    self._q.task_done()
+
+            if any(it is _STOP for it in batch):
+                conn.close()
+                return
+
+    def _journal_row(self, recorded_at: str, s: dict, sent: bool) -> tuple:
+        return (
+            recorded_at, s.get("market") or self.market, self.timeframe, s["symbol"], s["direction"],
+            s["candle_open_time_utc"], s["candle_close_time_utc"],
+            s["entry"], s["stop"], s["tp1"], s["tp2"], s["r"], s["reason"], int(sent),
+        )
+
+    def _import_legacy_json(self, legacy_json: str):
+        """舊的 last_seen_local.json（symbol -> "close|direction"）只在 latest 表還空的時候匯入一次"""
+        if not os.path.exists(legacy_json):
+            return
+        if self._conn.execute("SELECT 1 FROM latest_signal LIMIT 1").fetchone():
+            return
+        try:
+            with open(legacy_json, "r", encoding="utf-8") as f:
+                old = json.load(f)
+        except Exception as e:
+            print(f"⚠️ skip legacy state {legacy_json}: {e}")
+            return
+
+        rows = []
+        for sym, v in old.items():
+            close, _, direction = str(v).rpartition("|")
+            if close and direction:
+                rows.append((self.market, self.timeframe, sym, close, direction, self.now().isoformat()))
+        _executemany_tx(
+            self._conn,
+            "INSERT OR IGNORE INTO latest_signal "
+            "(market, timeframe, symbol, candle_close_time_utc, direction, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
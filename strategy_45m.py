@@ -1,22 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
-import os, json, time
+import os, time
 import requests
 import pandas as pd
 import matplotlib.pyplot as plt
-from dataclasses import dataclass
-from datetime import datetime, timezone, timedelta
+from dataclasses import dataclass, asdict
+from datetime import timedelta
 
 import pytz  # ✅ 用來抓台灣時間並精準等到收線點
 
+from signal_store import SignalStore
+from chart_render import ChartPool, draw_signal_chart
+
 print("=== VERSION: BINGX | ONLY last 2 CLOSED 45m | SIGNAL only if ENGULFING | SIGNAL-ONLY OUTPUT | TG DEBUG ===")
 
 # =========================================================
 # Config
 # =========================================================
 BINGX_BASE = "https://open-api.bingx.com"
-STATE_FILE = "last_seen_local.json"
+STATE_DB = "signal_state.sqlite3"
+LEGACY_STATE_FILE = "last_seen_local.json"
 
 SOURCE_INTERVAL = "15m"
 TARGET_INTERVAL_MIN = 45
@@ -56,9 +60,15 @@ MAX_GOOD_WICK_TO_BODY_SHORT = 3.0  # 上引線 <= 3x body（放寬）
 SHOW_NO_SIGNAL_MSG = True
 NO_SIGNAL_MSG_TEXT = "❌ No signals this run."
 
-# 是否畫圖（預設關閉，比較穩）
+# 是否跳出互動視窗畫圖（本機看圖用，排程上不要開）
 PLOT_ON_SIGNAL = False
 
+# 每個送出的 TG 訊號都附一張圖（背景 process 畫、背景送，不影響文字訊號）
+# PNG 送完就刪，CHART_DIR 只是暫存
+CHART_ON_SIGNAL = True
+CHART_WORKERS = 2
+CHART_DIR = "charts"
+
 # =========================================================
 # Telegram control
 # =========================================================
@@ -114,6 +124,10 @@ class Signal:
 def utc_now_ts() -> pd.Timestamp:
     return pd.Timestamp.now(tz="UTC")
 
+def sleep_seconds(seconds: float):
+    # ✅ 所有等待都走這裡（replay.py 會換成虛擬時鐘）
+    time.sleep(seconds)
+
 def interval_to_ms(interval: str) -> int:
     if interval.endswith("m"):
         return int(interval[:-1]) * 60_000
@@ -131,7 +145,7 @@ def wait_until_next_45m_close(grace_seconds: int = 10, tz_name: str = "Asia/Taip
     00:00, 00:45, 01:30, 02:15, 03:00, 03:45, ...（每45分鐘）
     """
     tz = pytz.timezone(tz_name)
-    now = datetime.now(tz)
+    now = utc_now_ts().to_pydatetime().astimezone(tz)
 
     day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     minutes_since = int((now - day_start).total_seconds() // 60)
@@ -144,7 +158,7 @@ def wait_until_next_45m_close(grace_seconds: int = 10, tz_name: str = "Asia/Taip
     wait_sec = (target - now).total_seconds()
     if wait_sec > 0:
         print(f"⏳ wait until 45m close: {target.strftime('%Y-%m-%d %H:%M:%S %Z')} (wait {wait_sec:.1f}s)")
-        time.sleep(wait_sec)
+        sleep_seconds(wait_sec)
 
 def wick_ok_by_direction(o, h, l, c, direction: str) -> bool:
     """
@@ -176,29 +190,22 @@ def body_to_range_ratio(o, h, l, c) -> float:
     body = abs(c - o)
     return body / rng
 
-def load_state():
-    try:
-        if not os.path.exists(STATE_FILE):
-            return {}
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-def save_state(state):
-    try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
-
-def should_show(symbol, candle_close_time_utc, direction, state):
-    key = symbol
-    cur = f"{candle_close_time_utc}|{direction}"
-    if state.get(key) == cur:
-        return False
-    state[key] = cur
-    return True
+def load_state() -> SignalStore:
+    # 第一次跑會把舊的 last_seen_local.json 匯進來
+    return SignalStore(
+        STATE_DB,
+        market="bingx_swap",
+        timeframe=f"{TARGET_INTERVAL_MIN}m",
+        legacy_json=LEGACY_STATE_FILE,
+        now=lambda: utc_now_ts(),  # 每次現查（replay.py 會換成虛擬時鐘）
+    )
+
+def save_state(state: SignalStore):
+    # 每筆都已經寫進 DB，這裡只等背景 journal 寫完
+    state.flush()
+
+def should_show(symbol, candle_close_time_utc, direction, state: SignalStore):
+    return state.claim(symbol, candle_close_time_utc, direction)
 
 # =========================================================
 # Telegram (prints ONLY on failure)
@@ -228,6 +235,31 @@ def tg_send(text: str):
         except Exception as e:
             print(f"❌ TG exception chat_id={chat_id}: {e}")
 
+def tg_send_photo(path: str, caption: str = ""):
+    if not ENABLE_TG:
+        return
+    if not TG_BOT_TOKEN or not TG_CHAT_IDS:
+        print("⚠️ TG config empty (TG_BOT_TOKEN / TG_CHAT_IDS).")
+        return
+
+    url = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendPhoto"
+
+    with open(path, "rb") as f:
+        photo = f.read()
+
+    for chat_id in TG_CHAT_IDS:
+        try:
+            resp = requests.post(
+                url,
+                data={"chat_id": chat_id, "caption": caption},
+                files={"photo": (os.path.basename(path), photo, "image/png")},
+                timeout=30
+            )
+            if resp.status_code != 200:
+                print(f"❌ TG photo failed chat_id={chat_id} status={resp.status_code} resp={resp.text}")
+        except Exception as e:
+            print(f"❌ TG photo exception chat_id={chat_id}: {e}")
+
 # =========================================================
 # Output format (your red-box block)
 # =========================================================
@@ -257,7 +289,7 @@ def format_signal_text_for_tg(sig: Signal) -> str:
 def fetch_bingx_swap_klines(symbol: str, interval: str = "15m", limit: int = 800) -> pd.DataFrame:
     url = f"{BINGX_BASE}/openApi/swap/v3/quote/klines"
 
-    now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    now_ms = int(utc_now_ts().timestamp() * 1000)
     int_ms = interval_to_ms(interval)
     start_ms = now_ms - (limit * int_ms)
 
@@ -439,31 +471,27 @@ def compute_signal_only_if_last2_engulf(df45_closed: pd.DataFrame, symbol: str)
 # Plot (optional)
 # =========================================================
 def plot(df45_closed: pd.DataFrame, sig: Signal, bars: int = 140):
-    d = df45_closed.tail(bars).reset_index(drop=True)
-    fig, ax = plt.subplots(figsize=(12, 6))
-    ax.set_title(f"{sig.symbol} 45m | {sig.direction} | {sig.reason} | close={sig.candle_close_time_utc}")
-    ax.set_xlabel("Bars")
-    ax.set_ylabel("Price")
-
-    for i, row in d.iterrows():
-        o,h,l,c = row["open"], row["high"], row["low"], row["close"]
-        ax.plot([i,i], [l,h], linewidth=1)
-        bottom=min(o,c); height=abs(c-o) if abs(c-o)>0 else 1e-9
-        ax.add_patch(plt.Rectangle((i-0.3, bottom), 0.6, height))
-
-    ax.axhline(sig.entry, linestyle="--", linewidth=1)
-    ax.axhline(sig.stop,  linestyle="--", linewidth=1)
-    ax.axhline(sig.tp1,   linestyle="--", linewidth=1)
-    ax.axhline(sig.tp2,   linestyle="--", linewidth=1)
-
-    ax.grid(True, alpha=0.2)
-    plt.tight_layout()
+    d = df45_closed.tail(bars)
+    fig = plt.figure(figsize=(12, 6))
+    draw_signal_chart(fig, d[["open","high","low","close"]].to_numpy(dtype=float), asdict(sig))
     plt.show()
 
+def open_chart_pool(keep_files: bool = False) -> ChartPool | None:
+    if not (ENABLE_TG and CHART_ON_SIGNAL):
+        return None
+    # 用 lambda 每次現查 tg_send_photo（replay.py 會換掉它）
+    return ChartPool(
+        send=lambda path, caption: tg_send_photo(path, caption),
+        out_dir=CHART_DIR,
+        max_workers=CHART_WORKERS,
+        bars=PLOT_BARS,
+        keep_files=keep_files,
+    )
+
 # =========================================================
 # Scan once
 # =========================================================
-def scan_once(state: dict):
+def scan_once(state: SignalStore, charts: ChartPool | None = None):
     any_sig = False
 
     for sym, bingx_symbol in BINGX_SWAP_SYMBOLS.items():
@@ -478,12 +506,18 @@ def scan_once(state: dict):
                 any_sig = True
                 print(format_signal_block(sig))
 
-                if ENABLE_TG:
-                    if SEND_TG_ONLY_IF_NEW:
-                        if should_show(sym, sig.candle_close_time_utc, sig.direction, state):
-                            tg_send(format_signal_text_for_tg(sig))
-                    else:
-                        tg_send(format_signal_text_for_tg(sig))
+                is_new = should_show(sym, sig.candle_close_time_utc, sig.direction, state)
+                sent = ENABLE_TG and (is_new or not SEND_TG_ONLY_IF_NEW)
+                if sent:
+                    tg_send(format_signal_text_for_tg(sig))
+                state.append(sig, sent=sent)
+
+                # 圖只是附帶的：pool 壞了（例如 worker 被 OOM kill）只印出來，不影響訊號跟 journal
+                if sent and charts:
+                    try:
+                        charts.submit(df45_closed, sig)
+                    except Exception as e:
+                        print(f"❌ chart submit failed for {sym}: {e}")
 
                 if PLOT_ON_SIGNAL:
                     plot(df45_closed, sig, bars=PLOT_BARS)
@@ -496,15 +530,19 @@ def scan_once(state: dict):
 
 def run_every_45m():
     state = load_state()
+    charts = open_chart_pool()
     while True:
-        scan_once(state)
+        scan_once(state, charts)
         save_state(state)
-        time.sleep(45 * 60)
+        sleep_seconds(45 * 60)
 
 if __name__ == "__main__":
     # ✅ 關鍵：永遠等到下一個 45 分收線點（台灣時間）後才開始跑
     wait_until_next_45m_close(grace_seconds=GRACE_SECONDS, tz_name="Asia/Taipei")
 
     state = load_state()
-    scan_once(state)
-    save_state(state)
+    charts = open_chart_pool()
+    scan_once(state, charts)
+    state.close()
+    if charts:
+        charts.close()  # 等圖畫完送完再結束